@@ -100,6 +100,11 @@ other dependencies have changed. Dependencies can be declared from inside `a.tex
 `pyp.dep(...)`. Caching can be completely disabled with `pyp.disable_cache=True`,
 and users can delete `a.pickle` as necessary.
 
+When the cache is used, the Python fragments are not executed. Besides their outputs,
+the cache restores the fields `pyp.argv`, `pyp.bibs`, `pyp.deps`, `pyp.disable_cache`,
+`pyp.gencount`, `pyp.gendir`, `pyp.latex` and `pyp.latexcommand`, but any other
+attributes that the fragments set on `pyp` are not cached.
+
 # Scopes
 
 For each template file `a.tex`, `b.tex`, ... a private global scope is created for
@@ -129,35 +134,89 @@ pyptex $1
 ```
 """
 
-from contextlib import suppress
+import atexit
+from contextlib import redirect_stderr, redirect_stdout, suppress
 import datetime
+import functools
 import glob
+import hashlib
+import importlib.util
 import inspect
+import io
+import marshal
 import os
 import pickle
 import re
+import select
 import string
-import subprocess
 import sys
+import threading
 import time
 import traceback
 import weakref
 
-import numpy
-import sympy
-
 
 __pdoc__ = {
+    'pyptex.appender': False,
     'pyptex.compile': False,
     'pyptex.generateddir': False,
     'pyptex.process': False,
     'pyptex.resolvedeps': False,
     'pyptex.run': False,
+    'pyptex.subber': False,
+    'pyptex.tokenize': False,
 }
 
-pypparser = re.compile(r'((?<!\\)%[^\n]*\n)|(@@{)|(@{([^{}]+)}|@{{{(.*?)}}})', re.DOTALL)
 bibentryname = re.compile(r'[^{]*{([^,]*),', re.DOTALL)
 stripext = re.compile(r'(.*?)(\.(pyp\.)?[^\.]*)?$', re.DOTALL)
+cachedfields = ('argv', 'bibs', 'deps', 'disable_cache', 'fragments', 'gencount', 'gendir',
+                'latex', 'latexcommand', 'outputs')
+
+
+__pdoc__['nextfragment'] = False
+def nextfragment(S, pos):
+    """Locate the first `@@{`, `@{...}` or `@{{{...}}}` at or after `pos` in `S`.
+    Returns `(start, end, z0, z1)`, where `S[z0:z1]` is the Python code and
+    `z0 = z1 = -1` for `@@{`, or None if there is no such fragment."""
+    find = S.find
+    startswith = S.startswith
+    while True:
+        start = find('@', pos)
+        if start < 0:
+            return None
+        pos = start + 1
+        if startswith('@{', pos):
+            return start, start + 3, -1, -1
+        if not startswith('{', pos):
+            continue
+        z0 = start + 2
+        z1 = find('}', z0)
+        if z1 > z0 and find('{', z0, z1) < 0:
+            return start, z1 + 1, z0, z1
+        if startswith('{{', z0):
+            z0 += 2
+            z1 = find('}}}', z0)
+            if z1 >= 0:
+                return start, z1 + 3, z0, z1
+
+
+__pdoc__['commentend'] = False
+def commentend(S, pos, end):
+    """If a TeX comment starting in `S[pos:end]` runs past `end`, return the index
+    just after the newline that ends it. Otherwise, return -1."""
+    while True:
+        pos = S.find('%', pos, end)
+        if pos < 0:
+            return -1
+        if pos > 0 and S[pos-1] == '\\':
+            pos += 1
+            continue
+        pos = S.find('\n', pos)
+        if pos < 0:
+            return -1
+        pos += 1
+        if pos > end:
+            return pos
 
 
 __pdoc__['format_my_nanos'] = False
@@ -168,19 +227,40 @@ def format_my_nanos(nanos: int):
     return '{}.{:09.0f}'.format(dt.strftime('%Y-%m-%d@%H:%M:%S'), nanos % 1e9)
 
 
+__pdoc__['format_mtime'] = False
+def format_mtime(mtime):
+    """Convert a dependency timestamp to a human-readable format, or '' if the
+    dependency was missing."""
+    return format_my_nanos(mtime) if isinstance(mtime, int) and mtime >= 0 else ''
+
+
 __pdoc__['dictdiff'] = False
 def dictdiff(A, B):
-    A = set(A.items())
-    B = set(B.items())
-    D = A ^ B
-    if len(D) == 0:
-        return None
-    return next(iter(D))
+    for k, v in A.items():
+        if k not in B or B[k] != v:
+            return k, v
+    for k, v in B.items():
+        if k not in A:
+            return k, v
+    return None
+
+
+__pdoc__['fragmenthashes'] = False
+def fragmenthashes(fragments):
+    """Hash each fragment, so that the cached fragments can be compared cheaply."""
+    return [hashlib.blake2b(C.encode(), digest_size=16).digest() for C in fragments]
 
 
 __pdoc__['mylatex'] = False
 def mylatex(X):
-    return sympy.latex(X) if X is not None else ''
+    if X is None:
+        return ''
+    if isinstance(X, str):
+        return X
+    if type(X) is int:
+        return str(X)
+    import sympy
+    return sympy.latex(X)
 
 
 __pdoc__['latextemplate'] = False
@@ -188,6 +268,12 @@ class latextemplate(string.Template):
     delimiter = '@'
 
 
+__pdoc__['pptemplate'] = False
+@functools.lru_cache(maxsize=1024)
+def pptemplate(Z):
+    return latextemplate(Z)
+
+
 __pdoc__['LatexDict'] = False
 class LatexDict:
     def __init__(self, glob, loc):
@@ -195,7 +281,11 @@ class LatexDict:
         self.glob = glob
 
     def __getitem__(self, key):
-        return mylatex(self.loc[key] if key in self.loc else self.glob[key])
+        try:
+            X = self.loc[key]
+        except KeyError:
+            X = self.glob[key]
+        return mylatex(X)
 
 
 def pp(Z, levels: int = 1):
@@ -211,7 +301,7 @@ def pp(Z, levels: int = 1):
         levels -= 1
 #    foo = LatexDict({k: v for d in [foo.f_globals, foo.f_locals] for k, v in d.items()})
     foo = LatexDict(foo.f_globals, foo.f_locals)
-    D = latextemplate(Z)
+    D = pptemplate(Z)
     txt = D.substitute(foo)
     return txt
 
@@ -225,6 +315,9 @@ class pyptex:
     available as `pyp.compiled`.
     """
 
+    # Compiled Python fragments, keyed by (texfilename, line offset, source).
+    _code_cache = {}
+
     def genname(self, pattern: str = 'fig{gencount}.eps'):
         r"""Generate a filename
 
@@ -260,6 +353,7 @@ class pyptex:
         `\\includegraphics{@{pyp.savefig(...)}}`
         """
         if self.__sympy_plot__ is None:
+            import sympy.plotting
             self.__sympy_plot__ = sympy.plotting.plot(1, show=False).__class__
         figname = self.genname(pattern)
         if fig.__class__ == self.__sympy_plot__:
@@ -271,6 +365,12 @@ class pyptex:
         self.dep(figname)
         return figname
 
+    @property
+    def compiled(self):
+        """The contents of the `a.pyptex` output file."""
+        with open(self.pyptexfilename, 'rt') as file:
+            return file.read()
+
     def generateddir(self):
         """This is an internal function that creates the generated directory."""
         self.gendir = f'{self.filename}-generated'
@@ -316,14 +416,15 @@ class pyptex:
           or if tracking dependencies is too hard, disabling all caching will ensure
           that `a.pyptex` is correctly compiled into `a.pdf` and that a stale cache is
           never used.
-        * `pyp.deps` is a dictionary of dependencies and timestamps.
+        * `pyp.deps` is a dictionary of dependencies and timestamps (`st_mtime_ns`, or -1
+          if the dependency is missing).
         * `pyp.lc` counts lines while parsing.
         * `pyp.argv` stores the ``command-line arguments'' for template generation.
         * `pyp.exitcode` is the exit code of the `pyp.latexcommand`.
         * `pyp.gencount` is the counter for generated files (see `pyp.gen()`).
         * `pyp.fragments` is the list of Python fragments extracted from a.tex.
         * `pyp.outputs` is the matching outputs.
-        * `pyp.compiled` is the string that is written to `a.pyptex`.
+        * `pyp.compiled` is the string that is written to `a.pyptex` (read back from disk).
         """
         print(f'{texfilename}: pyptex compilation begins')
         self.__globals__ = {'__builtins__': __builtins__, 'pyp': weakref.proxy(self)}
@@ -351,18 +452,20 @@ class pyptex:
     def run(self, S, k):
         """An internal function for executing Python code."""
         print(f'Executing Python code:\n{S}')
-        S = '\n'*k + S
+        key = (self.texfilename, k, S)
+        if key not in self._code_cache:
+            T = '\n'*k + S
+            code = None
+            with suppress(Exception):
+                code = (True, compile(T, self.texfilename, mode='eval'))
+            self._code_cache[key] = code or (False, compile(T, self.texfilename, mode='exec'))
+        doeval, C = self._code_cache[key]
         glob_ = self.__globals__
-        doeval = False
         self.accum = []
-        with suppress(Exception):
-            C = compile(S, self.texfilename, mode='eval')
-            doeval = True
         if doeval:
             ret = eval(C, glob_)
             self.accum.append(ret)
         else:
-            C = compile(S, self.texfilename, mode='exec')
             exec(C, glob_)
         print(f'Python result:\n{self.accum!s}')
         return self.accum
@@ -371,11 +474,19 @@ class pyptex:
         """If `pyp` is an object of type `pyptex`, `pyp.print(X)` causes `X` to be converted
         to its latex representation and substituted into the `a.pyptex` output file.
         The conversion is given by `sympy.latex(X)`, except that `None` is converted
-        to the empty string.
+        to the empty string and strings are inserted verbatim.
 
         Many values can be printed at once with the notation `pyp.print(X, Y, ...)`."""
         self.accum.extend(argv)
 
+    def print_many(self, seq, sep=', '):
+        """If `pyp` is an object of type `pyptex`, `pyp.print_many(seq)` converts each
+        element of `seq` to its latex representation, as in `pyp.print()`, and
+        substitutes them into the `a.pyptex` output file separated by `', '`.
+        The separator can be changed with `pyp.print_many(seq, sep)`, e.g.
+        `pyp.print_many(row, ' & ')` prints a row of a LaTeX table."""
+        self.accum.append(sep.join(map(mylatex, seq)))
+
     def cite(self,b):
         r"""If `pyp` is an object of type `pyptex`, then `pyp.cite(X)` adds the relevant
         entry to the bibTeX file and returns the entry name. Example usage:
@@ -385,25 +496,51 @@ class pyptex:
         self.bibs.append(b)
         return bibentryname.match(b).group(1).strip()
 
-    def process(self, S, runner):
-        """An internal helper function for parsing the input file."""
-        ln = numpy.cumsum(numpy.array(numpy.array(list(S), dtype='U1') == '\n', int))
-        ln = numpy.insert(ln, 0, 0)
-
-        def do_work(m):
-            if m.start(1) >= 0:
-                return m.group(0)
-            if m.start(2) >= 0:
-                return '@{'
-            for k in range(4, 6):
-                if m.start(k) >= 0:
-                    z = m.group(k)
-                    z0 = m.start(k)
-                    z1 = m.end(k)
-            self.lc += ln[z1] - ln[z0] + 1
-            return runner(z, ln[z0])
-
-        return pypparser.sub(do_work, S)
+    def tokenize(self, S):
+        """An internal helper function for locating the Python fragments of the input file."""
+        if '@' not in S:
+            return []
+        tokens = []
+        pos = 0
+        line = 0
+        counted = 0
+        while True:
+            fragment = nextfragment(S, pos)
+            if fragment is None:
+                break
+            start, end, z0, z1 = fragment
+            pos = commentend(S, pos, start)
+            if pos >= 0:
+                continue
+            pos = end
+            if z0 < 0:
+                tokens.append((start, end, None, 0))
+                continue
+            line += S.count('\n', counted, z0)
+            counted = z0
+            self.lc += S.count('\n', z0, z1) + 1
+            tokens.append((start, end, S[z0:z1], line))
+        return tokens
+
+    def process(self, S, tokens, runner):
+        """An internal helper function that yields the chunks of the output file."""
+        prev = 0
+        for start, end, C, k in tokens:
+            yield S[prev:start]
+            yield '@{' if C is None else runner(C, k)
+            prev = end
+        yield S[prev:]
+
+    def subber(self, C, k):
+        """An internal runner that substitutes the cached output of a Python fragment."""
+        self.subcount += 1
+        return self.outputs[self.subcount]
+
+    def appender(self, C, k):
+        """An internal runner that executes a Python fragment and records its output."""
+        result = self.run(C, k)
+        self.outputs.append(''.join(map(mylatex, result)))
+        return self.outputs[-1]
 
     def compile(self):
         """An internal function for compiling the input file."""
@@ -414,8 +551,13 @@ class pyptex:
                 cache = pickle.load(file)
         except Exception:
             cache = {}
+        magic, codes = cache.pop('codes', (None, {}))
+        if magic == importlib.util.MAGIC_NUMBER:
+            for k, (doeval, C) in codes.items():
+                self._code_cache.setdefault(k, (doeval, marshal.loads(C)))
         defaults = {
             'fragments': [],
+            'hashes': [],
             'outputs': [],
             'deps': {},
             'argv': [],
@@ -424,19 +566,11 @@ class pyptex:
         for k, v in defaults.items():
             if k not in cache:
                 cache[k] = v
-        self.fragments = []
-
-        def scanner(C, k):
-            self.fragments.append(C)
-            return ''
-
-        self.process(text, runner=scanner)
+        tokens = self.tokenize(text)
+        self.fragments = [C for _, _, C, _ in tokens if C is not None]
+        hashes = fragmenthashes(self.fragments)
         print(f'Found {self.lc!s} lines of Python.')
         saveddeps = self.deps
-        self.deps = {}
-        for k in cache['deps']:
-            self.dep(k)
-        self.resolvedeps()
         cached = True
         if cache['disable_cache']:
             print('disable_cache=True')
@@ -444,63 +578,66 @@ class pyptex:
         elif cache['argv'] != self.argv:
             print('argv differs', self.argv, cache['argv'])
             cached = False
-        elif cache['fragments'] != self.fragments:
+        elif cache['hashes'] != hashes:
             F1 = dict(enumerate(cache['fragments']))
             F2 = dict(enumerate(self.fragments))
-            k = dictdiff(F1, F2)[0]
+            k = next((k for k, (h1, h2) in enumerate(zip(cache['hashes'], hashes)) if h1 != h2),
+                     min(len(cache['hashes']), len(hashes)))
             print('Fragment #', k,
                   '\nCached version:\n', F1[k] if k in F1 else None,
                   '\nLive version:\n', F2[k] if k in F2 else None)
             cached = False
-        elif self.deps != cache['deps']:
-            F1 = cache['deps']
-            F2 = self.deps
-            k = dictdiff(F1, F2)[0]
-            print('Dependency mismatch', k,
-                  '\nCached version:\n', F1[k] if k in F1 else None,
-                  '\nLive version:\n', F2[k] if k in F2 else None)
-            cached = False
+        else:
+            self.deps = {}
+            for k in cache['deps']:
+                self.dep(k)
+            self.resolvedeps()
+            if self.deps != cache['deps']:
+                F1 = cache['deps']
+                F2 = self.deps
+                k = dictdiff(F1, F2)[0]
+                print('Dependency mismatch', k,
+                      '\nCached version:\n', format_mtime(F1[k]) if k in F1 else None,
+                      '\nLive version:\n', format_mtime(F2[k]) if k in F2 else None)
+                cached = False
         if cached:
             print('Using cached Python outputs')
-            for k, v in cache.items():
-                self.__dict__[k] = v
+            for k in cachedfields:
+                if k in cache:
+                    self.__dict__[k] = cache[k]
             self.subcount = -1
-
-            def subber(C, k):
-                self.subcount += 1
-                return self.outputs[self.subcount]
-
-            self.compiled = self.process(text, runner=subber)
+            runner = self.subber
         else:
             print('Cache is invalidated.')
             self.deps = saveddeps
             self.outputs = []
-
-            def appender(C, k):
-                result = self.run(C, k)
-                self.outputs.append(''.join(map(mylatex, result)))
-                return self.outputs[-1]
-
-            self.compiled = self.process(text, runner=appender)
+            runner = self.appender
+        # Fragments run while the output is written, so write to a temporary file and
+        # only replace a.pyptex once every fragment has succeeded.
+        tmpfilename = f'{self.pyptexfilename}.tmp'
+        try:
+            with open(tmpfilename, 'wt', buffering=1 << 20) as file:
+                file.writelines(self.process(text, tokens, runner))
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tmpfilename)
+            raise
+        os.replace(tmpfilename, self.pyptexfilename)
         sys.stdout.flush()
-        if self.pyptexfilename:
-            print(f'Saving to file: {self.pyptexfilename}')
-            with open(self.pyptexfilename, 'wt') as file:
-                file.write(self.compiled)
-        self.resolvedeps()
-        print(f'Dependencies are:\n{self.deps!s}')
+        print(f'Saving to file: {self.pyptexfilename}')
+        if not cached:
+            self.resolvedeps()
+        print(f'Dependencies are:\n{ {k: format_mtime(v) for k, v in self.deps.items()}!s}')
         if not cached:
             print('Saving cache file', self.cachefilename)
             with open(self.cachefilename, 'wb') as file:
-                cache = {}
-                for k, v in self.__dict__.items():
-                    if k[0:2] == '__' and k[-2:] == '__':
-                        pass
-                    elif callable(v):
-                        pass
-                    else:
-                        cache[k] = v
-                pickle.dump(cache, file)
+                cache = {k: self.__dict__[k] for k in cachedfields if k in self.__dict__}
+                cache['hashes'] = hashes
+                live = {(self.texfilename, k, C) for _, _, C, k in tokens if C is not None}
+                cache['codes'] = (importlib.util.MAGIC_NUMBER, {
+                    k: (doeval, marshal.dumps(C))
+                    for k, (doeval, C) in self._code_cache.items() if k in live})
+                pickle.dump(cache, file, protocol=pickle.HIGHEST_PROTOCOL)
         if self.latexcommand:
             cmd = self.latexcommand.format(**self.__dict__)
             print(f'Running Latex command:\n{cmd}')
@@ -538,17 +675,17 @@ class pyptex:
 
         For convenience, `pyp.dep(filename)` returns filename.
         """
-        self.deps[filename] = ''
+        self.deps[filename] = -1
         return filename
 
     def resolvedeps(self):
         """An internal function that actually computes the datestamps of dependencies."""
         for k in self.deps:
             try:
-                ds = format_my_nanos(os.stat(k).st_mtime_ns)
+                mtime = os.stat(k).st_mtime_ns
             except Exception:
-                ds = ''
-            self.deps[k] = ds
+                mtime = -1
+            self.deps[k] = mtime
 
     def input(self, filename, argv=False):
         r"""If `pyp = pyptex('a.tex')` then
@@ -577,6 +714,34 @@ class pyptex:
         ret = pyptex(filename, argv or self.argv, False)
         return fr'\input{{{ret.pyptexfilename}}}'
 
+    def inputs(self, filenames, argvs=None):
+        r"""If `pyp = pyptex('a.tex')` then
+        `pyp.inputs(['b.tex', 'c.tex'])`
+        compiles `b.tex` and `c.tex` in parallel worker processes and returns the list
+        `[r'\input{b.pyptex}', r'\input{c.pyptex}']`. This is the batch version of
+        `pyp.input()`, and a typical way of using it is
+        `@{"\n".join(pyp.inputs(['b.tex', 'c.tex']))}`.
+
+        Since each file is a separate "compilation unit" (see `pyp.input()`), the files
+        can be compiled independently. `pyp.inputs(filenames, argvs)` passes `argvs[i]`
+        as the `argv` of `filenames[i]`; any missing or empty entry defaults to `pyp.argv`.
+
+        The Python output of each worker is collected and printed, in the order of
+        `filenames`, once all the files are compiled. This works with any
+        multiprocessing start method. Output that subprocesses write directly to the
+        stdout file descriptor is not collected, and may appear out of order.
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        argvs = list(argvs or [])
+        argvs += [None]*(len(filenames)-len(argvs))
+        jobs = [(filename, argv or self.argv) for filename, argv in zip(filenames, argvs)]
+        sys.stdout.flush()
+        with ProcessPoolExecutor() as executor:
+            rets = list(executor.map(compilechild, jobs))
+        for _, log in rets:
+            sys.stdout.write(log)
+        return [fr'\input{{{ret}}}' for ret, _ in rets]
+
     def open(self, filename, *argv, **kwargs):
         """If pyp = pyptex('a.tex') then pyp.open(filename, ...) is a wrapper for
         the builtin function open(filename, ...) that further adds filename to
@@ -586,6 +751,75 @@ class pyptex:
         return open(filename, *argv, **kwargs)
 
 
+__pdoc__['compilechild'] = False
+def compilechild(job):
+    """Compile one file for `pyptex.inputs()` in a worker process, and return the name
+    of the output file together with the Python output of the compilation."""
+    filename, argv = job
+    log = io.StringIO()
+    try:
+        with redirect_stdout(log), redirect_stderr(log):
+            ret = pyptex(filename, argv, False).pyptexfilename
+    except BaseException:
+        sys.stdout.write(log.getvalue())
+        raise
+    return ret, log.getvalue()
+
+
+__pdoc__['tee'] = False
+def tee(filename):
+    """Copy everything written to the file descriptors of stdout and stderr to the
+    file `filename`, as well as to the original stdout. Since this works at the level
+    of file descriptors, it also captures output from subprocesses and C extensions."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log = open(filename, 'wb', buffering=0)
+    stdout = os.dup(1)
+    stderr = os.dup(2)
+    r, w = os.pipe()
+    os.dup2(w, 1)
+    os.dup2(w, 2)
+    os.close(w)
+
+    done = threading.Event()
+
+    def pump():
+        # A destination that fails (e.g. a closed pipe with `pyptex a.tex | head`) is
+        # dropped, but the pipe is still drained so that writers never block.
+        outs = [log.fileno(), stdout]
+        while True:
+            if not select.select([r], [], [], 0.05)[0]:
+                # Once stop() has run, an empty pipe means we are done, even if a
+                # background subprocess still holds its write end open.
+                if done.is_set():
+                    break
+                continue
+            chunk = os.read(r, 1 << 16)
+            if not chunk:
+                break
+            for fd in list(outs):
+                try:
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(fd, view):]
+                except OSError:
+                    outs.remove(fd)
+        log.close()
+
+    def stop():
+        with suppress(Exception):
+            sys.stdout.flush()
+            sys.stderr.flush()
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        done.set()
+        thread.join()
+
+    thread = threading.Thread(target=pump, daemon=True)
+    thread.start()
+    atexit.register(stop)
+
+
 def pyptexmain(argv: list = None):
     """This function parses an input file a.tex to produce a.pyptex and a.pdf, by
     doing pyp = pyptex('a.tex', ...) object. The filename a.tex must be in argv[1];
@@ -594,6 +828,8 @@ def pyptexmain(argv: list = None):
     If an exception occurs, pdb is automatically invoked in postmortem mode.
     If "--pdb=no" is in argv, it is removed from argv and automatic pdb postmortem is disabled.
     If "--pdb=yes" is in argv, automatic pdb postmortem is enabled. This is the default.
+    Everything written to stdout and stderr, including by subprocesses, is also logged
+    to a.pyplog.
     """
     argv = argv or sys.argv
     dopdb = True
@@ -607,10 +843,7 @@ def pyptexmain(argv: list = None):
         print('Usage: pyptex <filename.tex> ...')
         sys.exit(1)
     try:
-        # logging inspired by Jacob Gabrielson on Stackoverflow
-        tee = subprocess.Popen(['tee', f'{os.path.splitext(argv[1])[0]}.pyplog'], stdin=subprocess.PIPE)
-        os.dup2(tee.stdin.fileno(), sys.stdout.fileno())
-        os.dup2(tee.stdin.fileno(), sys.stderr.fileno())
+        tee(f'{os.path.splitext(argv[1])[0]}.pyplog')
         pyp = pyptex(argv[1], argv[2:],
             latexcommand=r'{latex} {pyptexfilename} && (test ! -f {bibfilename} || bibtex {auxfilename})')
     except Exception: